@@ -8,8 +8,14 @@ class Config:
     REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
     CHROMA_HOST = os.getenv("CHROMA_HOST", "localhost")
     CHROMA_PORT = os.getenv("CHROMA_PORT", 8000)
+    # ONNX Runtime threads per worker for embeddings, 0 lets it use every core.
+    # By default the cores are split between the uvicorn workers
+    EMBED_THREADS = int(
+        os.getenv("EMBED_THREADS")
+        or max(1, (os.cpu_count() or 1) // int(os.getenv("WEB_CONCURRENCY", 1)))
+    )
     POSTGRES_HOST = os.getenv("POSTGRES_HOST", "localhost")
     POSTGRES_DB = os.getenv("POSTGRES_DB", "webtracker")
     POSTGRES_USER = os.getenv("POSTGRES_USER", "user")
     POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD", "password")
-    POSTGRES_URL = f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}/{POSTGRES_DB}"
+    POSTGRES_URL = f"postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}/{POSTGRES_DB}"
@@ -1,8 +1,6 @@
 # api/database.py
-from datetime import datetime
 import uuid
 from sqlalchemy import (
-    create_engine,
     Column,
     String,
     Text,
@@ -10,17 +8,29 @@ from sqlalchemy import (
     ForeignKey,
     Boolean,
     Float,
-    JSON,
     Table,
     Integer,
+    Index,
+    UniqueConstraint,
+    DDL,
+    event,
+    func,
+    select,
 )
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import relationship
+from sqlalchemy.dialects.postgresql import JSONB, UUID
 from config import Config
 
-engine = create_engine(Config.POSTGRES_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+engine = create_async_engine(
+    Config.POSTGRES_URL,
+    insertmanyvalues_page_size=1000,
+    pool_pre_ping=True,
+    pool_size=20,
+    max_overflow=10,
+)
+SessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
 
 Base = declarative_base()
 
@@ -31,7 +41,13 @@ website_cookie = Table(
     Column(
         "website_id", UUID(as_uuid=True), ForeignKey("websites.id"), primary_key=True
     ),
-    Column("cookie_id", UUID(as_uuid=True), ForeignKey("cookies.id"), primary_key=True),
+    Column(
+        "cookie_id",
+        UUID(as_uuid=True),
+        ForeignKey("cookies.id"),
+        primary_key=True,
+        index=True,
+    ),
 )
 
 website_topsite = Table(
@@ -41,7 +57,11 @@ website_topsite = Table(
         "website_id", UUID(as_uuid=True), ForeignKey("websites.id"), primary_key=True
     ),
     Column(
-        "topsite_id", UUID(as_uuid=True), ForeignKey("top_sites.id"), primary_key=True
+        "topsite_id",
+        UUID(as_uuid=True),
+        ForeignKey("top_sites.id"),
+        primary_key=True,
+        index=True,
     ),
 )
 
@@ -63,12 +83,16 @@ class Website(Base):
 
 class Visit(Base):
     __tablename__ = "visits"
+    __table_args__ = (
+        Index("ix_visit_website_hash", "website_id", "content_hash"),
+        Index("ix_visit_website_version", "website_id", "version"),
+    )
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4, index=True)
     website_id = Column(UUID(as_uuid=True), ForeignKey("websites.id"))
-    timestamp = Column(DateTime, index=True, default=datetime.utcnow)
+    timestamp = Column(DateTime(timezone=True), index=True, server_default=func.now())
     version = Column(Integer)
-    content_hash = Column(String)
+    content_hash = Column(String(64))
     cleaned_content = Column(Text)
     title = Column(String)
 
@@ -79,15 +103,33 @@ class Visit(Base):
     geolocation = relationship("Geolocation", uselist=False, back_populates="visit")
 
 
+def supports_lz4(ddl, target, bind, **kw):
+    return bind.dialect.server_version_info >= (14,)
+
+
+# Page bodies are large and read back whole; lz4 TOAST compression
+# (Postgres 14+) decompresses noticeably faster than the pglz default
+event.listen(
+    Visit.__table__,
+    "after_create",
+    DDL(
+        "ALTER TABLE visits ALTER COLUMN cleaned_content SET COMPRESSION lz4"
+    ).execute_if(callable_=supports_lz4),
+)
+
+
 class Cookie(Base):
     __tablename__ = "cookies"
+    __table_args__ = (UniqueConstraint("name", "domain", name="uq_cookie_name_domain"),)
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4, index=True)
     name = Column(String)
     domain = Column(String)
     path = Column(String)
-    cookie_raw = Column(JSON)
-    last_seen = Column(DateTime, default=datetime.utcnow)
+    cookie_raw = Column(JSONB)
+    last_seen = Column(
+        DateTime(timezone=True), server_default=func.now(), onupdate=func.now()
+    )
     websites = relationship(
         "Website", secondary=website_cookie, back_populates="cookies"
     )
@@ -110,7 +152,9 @@ class TopSite(Base):
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4, index=True)
     url = Column(String, unique=True)
     title = Column(String)
-    last_seen = Column(DateTime, default=datetime.utcnow)
+    last_seen = Column(
+        DateTime(timezone=True), server_default=func.now(), onupdate=func.now()
+    )
     websites = relationship(
         "Website", secondary=website_topsite, back_populates="top_sites"
     )
@@ -118,12 +162,22 @@ class TopSite(Base):
 
 class BrowsingHistory(Base):
     __tablename__ = "browsing_history"
+    __table_args__ = (Index("ix_bh_time_id", "last_visit_time", "id"),)
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4, index=True)
-    url = Column(String, index=True)
+    url = Column(String, unique=True, index=True)
     title = Column(String)
-    last_visit_time = Column(DateTime, index=True)
+    last_visit_time = Column(DateTime(timezone=True))
     visit_count = Column(Integer, default=1)
 
 
-Base.metadata.create_all(bind=engine)
+# Arbitrary key for the advisory lock that serializes schema creation
+SCHEMA_LOCK_ID = 0x5C4E3A
+
+
+async def init_db():
+    async with engine.begin() as conn:
+        # Every uvicorn worker runs this at startup; the transaction-level lock
+        # makes the others wait and then find the tables already created
+        await conn.execute(select(func.pg_advisory_xact_lock(SCHEMA_LOCK_ID)))
+        await conn.run_sync(Base.metadata.create_all)
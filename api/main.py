@@ -1,78 +1,365 @@
 # api/main.py
-from fastapi import FastAPI, Depends
-from sqlalchemy.orm import Session
-from pydantic import BaseModel
-from datetime import datetime
+from fastapi import FastAPI, Depends, HTTPException, Query, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.middleware.gzip import GZipMiddleware
+from sqlalchemy import func, literal, select, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import raiseload
+from pydantic import BaseModel, ConfigDict
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from functools import cached_property
+from typing import Optional
+import asyncio
+import base64
+import hashlib
+import logging
+import os
+import uuid
 import chromadb
+from chromadb.config import Settings
+from chromadb.utils.embedding_functions import ONNXMiniLM_L6_V2
 from database import (
     SessionLocal,
+    init_db,
     Website,
     Visit,
     BrowsingHistory,
     TopSite,
     Cookie,
     Geolocation,
+    website_cookie,
+    website_topsite,
 )
 from config import Config
-from markdownify import markdownify as md
+from bs4 import BeautifulSoup
+from markdownify import MarkdownConverter
+
+logger = logging.getLogger(__name__)
+
+# Visits waiting to be embedded and added to Chroma
+EMBED_BATCH_SIZE = 32
+EMBED_MAX_WAIT = 0.05
+EMBED_QUEUE_SIZE = 1000
+embed_queue: Optional[asyncio.Queue] = None
+# Embedding gets its own thread so it never competes with clean_content for
+# the shared request threadpool
+embed_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embed")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global embed_queue, collection
+    await init_db()
+    chroma_client = await chromadb.AsyncHttpClient(
+        host=Config.CHROMA_HOST,
+        port=Config.CHROMA_PORT,
+        settings=Settings(anonymized_telemetry=False),
+    )
+    collection = await chroma_client.get_or_create_collection("web_history")
+    # Load the ONNX session now rather than on the first batch of visits
+    await asyncio.get_running_loop().run_in_executor(
+        embed_pool, embedding_model, ["warm up"]
+    )
+    embed_queue = asyncio.Queue(maxsize=EMBED_QUEUE_SIZE)
+    indexer = asyncio.create_task(index_visits())
+    yield
+    await embed_queue.join()
+    indexer.cancel()
+    embed_pool.shutdown()
+
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(GZipMiddleware, minimum_size=1024)
 
 
 # Dependency to get the database session
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
-# Chroma client
-chroma_client = chromadb.HttpClient(host=Config.CHROMA_HOST, port=Config.CHROMA_PORT)
-collection = chroma_client.get_or_create_collection("web_history")
+# (url, content_hash) pairs already stored as visits, mapped to the website id.
+# Visits are never deleted, so a hit here can skip the duplicate-content probe
+KNOWN_CONTENT_SIZE = 10_000
+known_content = OrderedDict()
+
+
+def remember_content(key, website_id):
+    known_content[key] = website_id
+    known_content.move_to_end(key)
+    if len(known_content) > KNOWN_CONTENT_SIZE:
+        known_content.popitem(last=False)
+
+
+# Chroma collection, connected by each worker at startup
+collection = None
+
+
+class EmbeddingModel(ONNXMiniLM_L6_V2):
+    # Same session as Chroma builds, but with a configurable thread count so
+    # several uvicorn workers don't each spawn one ONNX thread per core
+    @cached_property
+    def model(self):
+        available = self.ort.get_available_providers()
+        if not self._preferred_providers:
+            self._preferred_providers = available
+        elif not set(self._preferred_providers).issubset(available):
+            raise ValueError(
+                f"Preferred providers must be subset of available providers: {available}"
+            )
+        # Chroma skips CoreML, it is slower than the CPU provider for this model
+        providers = [
+            p for p in self._preferred_providers if p != "CoreMLExecutionProvider"
+        ]
+
+        options = self.ort.SessionOptions()
+        options.log_severity_level = 3
+        options.graph_optimization_level = (
+            self.ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        if Config.EMBED_THREADS:
+            options.intra_op_num_threads = Config.EMBED_THREADS
+        options.inter_op_num_threads = 1
+        return self.ort.InferenceSession(
+            os.path.join(self.DOWNLOAD_PATH, self.EXTRACTED_FOLDER_NAME, "model.onnx"),
+            providers=providers,
+            sess_options=options,
+        )
+
+
+# Chroma's default embedding function builds a new ONNX Runtime session on
+# every call; keep one loaded model and pass embeddings to add() ourselves
+embedding_model = EmbeddingModel()
 
 
 class VisitData(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     timestamp: str
     url: str
     title: str
     content: str
-    contentHash: str
+    # Hint only, the server recomputes the hash from content
+    contentHash: Optional[str] = None
     version: int
     metadata: dict
 
 
+# Tags whose contents never belong in the stored markdown
+STRIP_TAGS = ("script", "style", "noscript", "iframe", "svg")
+
+# The converter only holds its options and a per-tag function cache,
+# so a single instance can be shared by every worker thread
+markdown_converter = MarkdownConverter()
+
+
 def clean_content(content: str) -> str:
-    markdown = md(content)
+    soup = BeautifulSoup(content, "lxml")
+    for tag in soup.find_all(STRIP_TAGS):
+        tag.decompose()
+    markdown = markdown_converter.convert_soup(soup)
     return markdown
 
 
+# Drains the embed queue into Chroma. After the first visit arrives it waits
+# up to EMBED_MAX_WAIT for more so the embedding model runs once per batch.
+async def index_visits():
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await embed_queue.get()]
+        deadline = loop.time() + EMBED_MAX_WAIT
+        while len(batch) < EMBED_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(embed_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        ids, documents, metadatas = zip(*batch)
+        try:
+            # Embedding is CPU-bound and runs on the embed thread; the add
+            # itself is plain HTTP on the shared async Chroma client
+            embeddings = await loop.run_in_executor(
+                embed_pool, embedding_model, list(documents)
+            )
+            await collection.add(
+                ids=list(ids),
+                embeddings=embeddings,
+                documents=list(documents),
+                metadatas=list(metadatas),
+            )
+        except Exception:
+            logger.exception("Failed to add %d visits to Chroma", len(batch))
+        finally:
+            for _ in batch:
+                embed_queue.task_done()
+
+
+async def record_metadata(db: AsyncSession, website_id, metadata: dict):
+    # Rows are sorted by their conflict key so concurrent upserts lock them in
+    # the same order and cannot deadlock
+
+    # Upsert cookies and link them to the website
+    cookies_data = {(c["name"], c["domain"]): c for c in metadata.get("cookies", [])}
+    if cookies_data:
+        stmt = pg_insert(Cookie).values(
+            [
+                dict(
+                    name=cookie_data["name"],
+                    domain=cookie_data["domain"],
+                    path=cookie_data["path"],
+                    cookie_raw=cookie_data,
+                )
+                for _, cookie_data in sorted(cookies_data.items())
+            ]
+        )
+        upserted = (
+            stmt.on_conflict_do_update(
+                index_elements=[Cookie.name, Cookie.domain],
+                set_={"last_seen": func.now()},
+            )
+            .returning(Cookie.id)
+            .cte("upserted_cookies")
+        )
+        # Upsert and link in one round-trip by feeding the CTE into the link insert
+        await db.execute(
+            pg_insert(website_cookie)
+            .from_select(
+                ["website_id", "cookie_id"],
+                select(
+                    literal(website_id, website_cookie.c.website_id.type),
+                    upserted.c.id,
+                ),
+            )
+            .on_conflict_do_nothing()
+        )
+
+    # Upsert top sites and link them to the website
+    top_sites_data = {s["url"]: s for s in metadata.get("topSites", [])}
+    if top_sites_data:
+        stmt = pg_insert(TopSite).values(
+            [
+                dict(url=site["url"], title=site["title"])
+                for _, site in sorted(top_sites_data.items())
+            ]
+        )
+        upserted = (
+            stmt.on_conflict_do_update(
+                index_elements=[TopSite.url],
+                set_={"last_seen": func.now()},
+            )
+            .returning(TopSite.id)
+            .cte("upserted_top_sites")
+        )
+        await db.execute(
+            pg_insert(website_topsite)
+            .from_select(
+                ["website_id", "topsite_id"],
+                select(
+                    literal(website_id, website_topsite.c.website_id.type),
+                    upserted.c.id,
+                ),
+            )
+            .on_conflict_do_nothing()
+        )
+
+    # Upsert browsing history
+    history_data = {}
+    history_counts = Counter()
+    for history_item in metadata.get("recentHistory", []):
+        history_data[history_item["url"]] = history_item
+        history_counts[history_item["url"]] += 1
+    if history_data:
+        stmt = pg_insert(BrowsingHistory).values(
+            [
+                dict(
+                    url=url,
+                    title=history_item["title"],
+                    last_visit_time=datetime.fromtimestamp(
+                        history_item["lastVisitTime"] / 1000, tz=timezone.utc
+                    ),
+                    visit_count=history_counts[url],
+                )
+                for url, history_item in sorted(history_data.items())
+            ]
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[BrowsingHistory.url],
+            set_={
+                "visit_count": BrowsingHistory.visit_count + stmt.excluded.visit_count,
+                "last_visit_time": func.greatest(
+                    BrowsingHistory.last_visit_time, stmt.excluded.last_visit_time
+                ),
+            },
+        )
+        await db.execute(stmt)
+
+
 @app.post("/visit")
-async def record_visit(visit_data: VisitData, db: Session = Depends(get_db)):
-    # Check if website exists, if not create it
-    website = db.query(Website).filter(Website.url == visit_data.url).first()
-    if not website:
-        website = Website(url=visit_data.url, latest_version=0)
-        db.add(website)
-        db.flush()
+async def record_visit(visit_data: VisitData, db: AsyncSession = Depends(get_db)):
+    # Unchanged content needs neither markdown conversion nor a new visit
+    content_hash = hashlib.sha256(
+        visit_data.content.encode("utf-8", "surrogatepass")
+    ).hexdigest()
+    content_key = (visit_data.url, content_hash)
+    website_id = known_content.get(content_key)
+    if website_id is None:
+        website_id = await db.scalar(
+            select(Visit.website_id)
+            .join(Website, Visit.website_id == Website.id)
+            .where(Website.url == visit_data.url, Visit.content_hash == content_hash)
+            .limit(1)
+        )
+    if website_id is not None:
+        # Only a new visit raises the latest version
+        await record_metadata(db, website_id, visit_data.metadata)
+        await db.commit()
+        remember_content(content_key, website_id)
+        return {
+            "message": f"Content unchanged for {visit_data.url} Version: {visit_data.version}"
+        }
 
     # Clean the content
-    cleaned_content = clean_content(visit_data.content)
+    # Markdown conversion is CPU-bound, keep it off the event loop
+    cleaned_content = await run_in_threadpool(clean_content, visit_data.content)
+
+    # Create the website or raise its latest version in a single statement
+    stmt = pg_insert(Website).values(
+        url=visit_data.url, latest_version=visit_data.version
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Website.url],
+        set_={
+            "latest_version": func.greatest(
+                Website.latest_version, stmt.excluded.latest_version
+            )
+        },
+    ).returning(Website.id)
+    website_id = await db.scalar(stmt)
 
-    # Create new visit
+    # One timestamp for both the visit row and its Chroma metadata
+    visited_at = datetime.now(timezone.utc)
+
+    # Create new visit; the id is generated here so no flush is needed
+    # before the geolocation row can reference it
     new_visit = Visit(
-        website_id=website.id,
-        timestamp=datetime.now(),
+        id=uuid.uuid4(),
+        website_id=website_id,
+        timestamp=visited_at,
         version=visit_data.version,
-        content_hash=visit_data.contentHash,
+        content_hash=content_hash,
         cleaned_content=cleaned_content,
         title=visit_data.title,
         is_bookmarked=visit_data.metadata.get("isBookmarked", False),
         idle_state=visit_data.metadata.get("idleState", ""),
     )
     db.add(new_visit)
-    db.flush()
 
     # Update or add geolocation
     geolocation = visit_data.metadata.get("geolocation")
@@ -84,72 +371,22 @@ async def record_visit(visit_data: VisitData, db: Session = Depends(get_db)):
         )
         db.add(new_geolocation)
 
-    # Update or add cookies
-    for cookie_data in visit_data.metadata.get("cookies", []):
-        cookie = (
-            db.query(Cookie)
-            .filter_by(name=cookie_data["name"], domain=cookie_data["domain"])
-            .first()
-        )
-        if not cookie:
-            cookie = Cookie(
-                name=cookie_data["name"],
-                domain=cookie_data["domain"],
-                path=cookie_data["path"],
-                cookie_raw=cookie_data,
-            )
-            db.add(cookie)
-        cookie.last_seen = datetime.utcnow()
-        if website not in cookie.websites:
-            cookie.websites.append(website)
-
-    # Update or add top sites
-    for site in visit_data.metadata.get("topSites", []):
-        top_site = db.query(TopSite).filter_by(url=site["url"]).first()
-        if not top_site:
-            top_site = TopSite(url=site["url"], title=site["title"])
-            db.add(top_site)
-        top_site.last_seen = datetime.utcnow()
-        if website not in top_site.websites:
-            top_site.websites.append(website)
-
-    # Update browsing history
-    for history_item in visit_data.metadata.get("recentHistory", []):
-        history_entry = (
-            db.query(BrowsingHistory).filter_by(url=history_item["url"]).first()
-        )
-        if history_entry:
-            history_entry.visit_count += 1
-            history_entry.last_visit_time = datetime.fromtimestamp(
-                history_item["lastVisitTime"] / 1000
-            )
-        else:
-            new_history = BrowsingHistory(
-                url=history_item["url"],
-                title=history_item["title"],
-                last_visit_time=datetime.fromtimestamp(
-                    history_item["lastVisitTime"] / 1000
-                ),
-                visit_count=1,
-            )
-            db.add(new_history)
-
-    # Update website's latest version
-    website.latest_version = max(website.latest_version, visit_data.version)
-
-    db.commit()
+    await record_metadata(db, website_id, visit_data.metadata)
+    await db.commit()
+    remember_content(content_key, website_id)
 
-    collection.add(
-        documents=[cleaned_content],
-        metadatas=[
+    # Queue the content for Chroma; it is embedded together with other visits
+    await embed_queue.put(
+        (
+            str(new_visit.id),
+            cleaned_content,
             {
                 "url": visit_data.url,
                 "title": visit_data.title,
-                "timestamp": datetime.timestamp(datetime.now()),
+                "timestamp": visited_at.timestamp(),
                 "version": visit_data.version,
-            }
-        ],
-        ids=[str(new_visit.id)],
+            },
+        )
     )
 
     return {
@@ -158,18 +395,38 @@ async def record_visit(visit_data: VisitData, db: Session = Depends(get_db)):
 
 
 @app.get("/latest_version")
-async def get_latest_version(url: str, db: Session = Depends(get_db)):
-    website = db.query(Website).filter(Website.url == url).first()
-    if website:
-        return {"latest_version": website.latest_version}
+async def get_latest_version(url: str, db: AsyncSession = Depends(get_db)):
+    latest_version = await db.scalar(
+        select(Website.latest_version).where(Website.url == url)
+    )
+    if latest_version is not None:
+        return {"latest_version": latest_version}
     return {"latest_version": 0}
 
 
 @app.get("/visits")
-async def get_visits(url: str, db: Session = Depends(get_db)):
-    website = db.query(Website).filter(Website.url == url).first()
+async def get_visits(
+    url: str,
+    limit: int = Query(1000, ge=1, le=1000),
+    offset: int = Query(0, ge=0),
+    db: AsyncSession = Depends(get_db),
+):
+    website = await db.scalar(select(Website).where(Website.url == url))
     if website:
-        visits = db.query(Visit).filter(Visit.website_id == website.id).all()
+        # Only the returned columns, so cleaned_content is never detoasted
+        visits = await db.execute(
+            select(
+                Visit.timestamp,
+                Visit.version,
+                Visit.title,
+                Visit.is_bookmarked,
+                Visit.idle_state,
+            )
+            .where(Visit.website_id == website.id)
+            .order_by(Visit.version, Visit.timestamp)
+            .limit(limit)
+            .offset(offset)
+        )
         return {
             "url": url,
             "visits": [
@@ -188,25 +445,50 @@ async def get_visits(url: str, db: Session = Depends(get_db)):
 
 @app.get("/browsing_history")
 async def get_browsing_history(
+    response: Response,
     url: str = None,
     start_date: str = None,
     end_date: str = None,
-    db: Session = Depends(get_db),
+    limit: int = Query(1000, ge=1, le=1000),
+    cursor: str = None,
+    db: AsyncSession = Depends(get_db),
 ):
-    query = db.query(BrowsingHistory)
+    query = select(BrowsingHistory)
 
     if url:
-        query = query.filter(BrowsingHistory.url == url)
+        query = query.where(BrowsingHistory.url == url)
 
     if start_date:
         start_date = datetime.fromisoformat(start_date)
-        query = query.filter(BrowsingHistory.last_visit_time >= start_date)
+        query = query.where(BrowsingHistory.last_visit_time >= start_date)
 
     if end_date:
         end_date = datetime.fromisoformat(end_date)
-        query = query.filter(BrowsingHistory.last_visit_time <= end_date)
+        query = query.where(BrowsingHistory.last_visit_time <= end_date)
+
+    # Keyset pagination: the cursor is the (last_visit_time, id) of the last row
+    if cursor:
+        try:
+            cursor_time, cursor_id = (
+                base64.urlsafe_b64decode(cursor).decode().split("|")
+            )
+            cursor_key = (datetime.fromisoformat(cursor_time), uuid.UUID(cursor_id))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query = query.where(
+            tuple_(BrowsingHistory.last_visit_time, BrowsingHistory.id) < cursor_key
+        )
 
-    history = query.all()
+    query = query.order_by(
+        BrowsingHistory.last_visit_time.desc(), BrowsingHistory.id.desc()
+    ).limit(limit)
+    history = (await db.scalars(query)).all()
+
+    if len(history) == limit:
+        last = history[-1]
+        response.headers["X-Next-Cursor"] = base64.urlsafe_b64encode(
+            f"{last.last_visit_time.isoformat()}|{last.id}".encode()
+        ).decode()
 
     return [
         {
@@ -220,8 +502,8 @@ async def get_browsing_history(
 
 
 @app.get("/top_sites")
-async def get_top_sites(db: Session = Depends(get_db)):
-    top_sites = db.query(TopSite).all()
+async def get_top_sites(db: AsyncSession = Depends(get_db)):
+    top_sites = await db.scalars(select(TopSite))
     return [
         {
             "url": site.url,
@@ -233,8 +515,10 @@ async def get_top_sites(db: Session = Depends(get_db)):
 
 
 @app.get("/geolocation/{visit_id}")
-async def get_geolocation(visit_id: int, db: Session = Depends(get_db)):
-    geolocation = db.query(Geolocation).filter(Geolocation.visit_id == visit_id).first()
+async def get_geolocation(visit_id: int, db: AsyncSession = Depends(get_db)):
+    geolocation = await db.scalar(
+        select(Geolocation).where(Geolocation.visit_id == visit_id)
+    )
     if geolocation:
         return {
             "latitude": geolocation.latitude,
@@ -244,14 +528,14 @@ async def get_geolocation(visit_id: int, db: Session = Depends(get_db)):
 
 
 @app.get("/cookies")
-async def get_cookies(url: str, db: Session = Depends(get_db)):
-    website = db.query(Website).filter(Website.url == url).first()
+async def get_cookies(url: str, db: AsyncSession = Depends(get_db)):
+    website = await db.scalar(select(Website).where(Website.url == url))
     if website:
-        cookies = (
-            db.query(Cookie)
+        cookies = await db.scalars(
+            select(Cookie)
+            .options(raiseload("*"))
             .join(Cookie.websites)
-            .filter(Website.id == website.id)
-            .all()
+            .where(Website.id == website.id)
         )
         return [
             {
@@ -0,0 +1,88 @@
+-- Brings a database created by an earlier version of the API up to the current
+-- schema. New databases do not need this, the API creates them on startup.
+--
+--   docker compose exec -T postgres psql -U <user> -d <db> < api/upgrade.sql
+--
+-- Stop the API first. Existing timestamps are assumed to be UTC, which is what
+-- the container clock was set to.
+
+BEGIN;
+
+-- Cookies: merge duplicate (name, domain) rows into the most recently seen one,
+-- then add the constraint the cookie upsert conflicts on
+CREATE TEMP TABLE cookie_dupes ON COMMIT DROP AS
+SELECT c.id, k.keep_id
+FROM cookies c
+JOIN (
+    SELECT DISTINCT ON (name, domain) name, domain, id AS keep_id
+    FROM cookies
+    ORDER BY name, domain, last_seen DESC NULLS LAST
+) k ON c.name = k.name AND c.domain = k.domain
+WHERE c.id <> k.keep_id;
+
+INSERT INTO website_cookie (website_id, cookie_id)
+SELECT wc.website_id, d.keep_id
+FROM website_cookie wc
+JOIN cookie_dupes d ON wc.cookie_id = d.id
+ON CONFLICT DO NOTHING;
+
+DELETE FROM website_cookie WHERE cookie_id IN (SELECT id FROM cookie_dupes);
+DELETE FROM cookies WHERE id IN (SELECT id FROM cookie_dupes);
+
+ALTER TABLE cookies ADD CONSTRAINT uq_cookie_name_domain UNIQUE (name, domain);
+ALTER TABLE cookies ALTER COLUMN cookie_raw TYPE JSONB USING cookie_raw::jsonb;
+ALTER TABLE cookies
+    ALTER COLUMN last_seen TYPE TIMESTAMP WITH TIME ZONE USING last_seen AT TIME ZONE 'UTC',
+    ALTER COLUMN last_seen SET DEFAULT now();
+
+-- Browsing history: merge duplicate urls by summing their visit counts, then
+-- make the url index unique for the history upsert
+CREATE TEMP TABLE history_dupes ON COMMIT DROP AS
+SELECT
+    url,
+    (array_agg(id ORDER BY last_visit_time DESC NULLS LAST))[1] AS keep_id,
+    sum(visit_count) AS visit_count,
+    max(last_visit_time) AS last_visit_time
+FROM browsing_history
+GROUP BY url
+HAVING count(*) > 1;
+
+UPDATE browsing_history bh
+SET visit_count = d.visit_count, last_visit_time = d.last_visit_time
+FROM history_dupes d
+WHERE bh.id = d.keep_id;
+
+DELETE FROM browsing_history bh
+USING history_dupes d
+WHERE bh.url = d.url AND bh.id <> d.keep_id;
+
+DROP INDEX IF EXISTS ix_browsing_history_url;
+CREATE UNIQUE INDEX ix_browsing_history_url ON browsing_history (url);
+DROP INDEX IF EXISTS ix_browsing_history_last_visit_time;
+ALTER TABLE browsing_history
+    ALTER COLUMN last_visit_time TYPE TIMESTAMP WITH TIME ZONE
+    USING last_visit_time AT TIME ZONE 'UTC';
+CREATE INDEX IF NOT EXISTS ix_bh_time_id ON browsing_history (last_visit_time, id);
+
+-- Top sites
+ALTER TABLE top_sites
+    ALTER COLUMN last_seen TYPE TIMESTAMP WITH TIME ZONE USING last_seen AT TIME ZONE 'UTC',
+    ALTER COLUMN last_seen SET DEFAULT now();
+
+-- Visits
+ALTER TABLE visits
+    ALTER COLUMN timestamp TYPE TIMESTAMP WITH TIME ZONE USING timestamp AT TIME ZONE 'UTC',
+    ALTER COLUMN timestamp SET DEFAULT now(),
+    ALTER COLUMN content_hash TYPE VARCHAR(64);
+CREATE INDEX IF NOT EXISTS ix_visit_website_hash ON visits (website_id, content_hash);
+CREATE INDEX IF NOT EXISTS ix_visit_website_version ON visits (website_id, version);
+
+-- Association tables, for lookups from the cookie or top site side
+CREATE INDEX IF NOT EXISTS ix_website_cookie_cookie_id ON website_cookie (cookie_id);
+CREATE INDEX IF NOT EXISTS ix_website_topsite_topsite_id ON website_topsite (topsite_id);
+
+COMMIT;
+
+-- Postgres 14+ only: compress visit content with lz4. This applies to newly
+-- written rows; run it separately since it fails on Postgres 13.
+-- ALTER TABLE visits ALTER COLUMN cleaned_content SET COMPRESSION lz4;